@@ -1,31 +1,76 @@
+if __name__ == "__main__":
+    # التشغيل المحلي عبر gevent: يجب تطبيق monkey patching قبل أي استيراد آخر
+    from gevent import monkey
+    monkey.patch_all()
+
 import os
-import uuid
-import time
-from typing import List, Dict, Optional
-from flask import Flask, jsonify, request, send_from_directory
-from dotenv import load_dotenv
-import vertexai
-from vertexai.generative_models import GenerativeModel, GenerationConfig, Tool, VertexAISearch
+from typing import Dict, Optional, Tuple
+from flask import Flask, Response, jsonify, request, send_from_directory, stream_with_context
+from werkzeug.exceptions import BadRequest, HTTPException, RequestEntityTooLarge
+from rag.core import (
+    PROJECT_ID,
+    VERTEX_RETRY_AFTER,
+    VertexUnavailable,
+    add_message,
+    answer_cache_info,
+    answer_cache_key,
+    build_contents,
+    conversation_store_name,
+    format_conversation_history,
+    generate_answer,
+    get_cached_answer,
+    get_conversation,
+    get_or_create_conversation,
+    model_ready,
+    open_answer_stream,
+    save_conversation,
+    warmup,
+)
+from rag.json_provider import OrjsonProvider
 
 # 1. إعداد المسارات المطلقة لضمان الوصول لمجلد public داخل الحاوية
-load_dotenv()
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-# 2. قراءة متغيرات البيئة (سيتم جلبها من إعدادات Cloud Run)
-PROJECT_ID = os.getenv("PROJECT_ID")
-LOCATION = os.getenv("LOCATION", "us-central1")
-# تصحيح: استخدام نموذج مستقر ومعروف لتجنب انهيار التطبيق
-MODEL = os.getenv("MODEL", "gemini-1.5-flash") 
-DATA_STORE_ID = os.getenv("DATA_STORE_ID")
-
-# 3. تهيئة Vertex AI
-if PROJECT_ID:
-    vertexai.init(project=PROJECT_ID, location=LOCATION)
-
-# 4. إعداد تطبيق Flask وتحديد مسار مجلد السكون بشكل مطلق
+# 2. إعداد تطبيق Flask وتحديد مسار مجلد السكون بشكل مطلق
 app = Flask(__name__, 
             static_folder=os.path.join(basedir, 'public'), 
             static_url_path='')
+app.json = OrjsonProvider(app)
+# رفض الطلبات الضخمة مبكراً قبل قراءتها وتحليلها (413)
+app.config["MAX_CONTENT_LENGTH"] = 64 * 1024
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({"error": "حجم الطلب أكبر من المسموح"}), 413
+
+@app.errorhandler(BadRequest)
+def bad_request(e):
+    return jsonify({"error": e.description}), 400
+
+def read_ask_payload() -> Tuple[str, Optional[str]]:
+    """قراءة السؤال ومعرف المحادثة من جسم الطلب، ورفض الصيغ غير الصحيحة بخطأ 400"""
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        raise BadRequest("صيغة الطلب غير صحيحة")
+
+    question = data.get("question") or ""
+    conv_id = data.get("conversation_id")
+    if not isinstance(question, str) or not (conv_id is None or isinstance(conv_id, str)):
+        raise BadRequest("صيغة الطلب غير صحيحة")
+
+    question = question.strip()
+    if not question:
+        raise BadRequest("يرجى إرسال سؤال صحيح")
+    return question, conv_id
+
+def model_not_ready():
+    return jsonify({"error": "إعدادات Vertex AI غير مكتملة (PROJECT_ID أو DATA_STORE_ID)"}), 500
+
+def service_busy():
+    """استجابة 503 سريعة مع Retry-After عند تقييد معدل Vertex AI أو فتح قاطع الدائرة"""
+    return jsonify({"error": "الخدمة مشغولة حالياً، يرجى المحاولة بعد قليل"}), 503, {"Retry-After": str(VERTEX_RETRY_AFTER)}
 
 @app.route("/")
 def index():
@@ -41,51 +86,117 @@ def index():
 
 @app.route("/api/health")
 def health():
-    return jsonify({"status": "ok", "project_id": PROJECT_ID})
+    return jsonify({
+        "status": "ok",
+        "project_id": PROJECT_ID,
+        "conversation_store": conversation_store_name(),
+        "answer_cache": answer_cache_info()
+    })
+
+@app.route("/api/conversation/new", methods=["POST"])
+def new_conversation():
+    return jsonify({"conversation_id": get_or_create_conversation().id})
+
+@app.route("/api/conversation/<conv_id>")
+def conversation_history(conv_id):
+    conversation = get_conversation(conv_id)
+    if conversation is None:
+        return jsonify({"error": "المحادثة غير موجودة أو انتهت صلاحيتها"}), 404
+    return jsonify(conversation.to_dict())
 
 @app.route("/api/ask", methods=["POST"])
 def ask():
     """معالجة أسئلة المستخدم باستخدام تقنية RAG"""
     try:
-        data = request.get_json(silent=True) or {}
-        question = data.get("question", "").strip()
-        
-        if not question:
-            return jsonify({"error": "يرجى إرسال سؤال صحيح"}), 400
-
-        if not DATA_STORE_ID:
-            return jsonify({"error": "إعدادات DATA_STORE_ID مفقودة"}), 500
-
-        # إعداد مسار البحث في مخزن البيانات
-        datastore_path = f"projects/{PROJECT_ID}/locations/{LOCATION}/collections/default_collection/dataStores/{DATA_STORE_ID}"
-        
-        # تجهيز أدوات البحث (Vertex AI Search)
-        tools = [Tool.from_retrieval(
-            vertexai.generative_models.Retrieval(
-                vertex_ai_search=VertexAISearch(datastore=datastore_path)
-            )
-        )]
-
-        # استدعاء نموذج Gemini
-        model = GenerativeModel(MODEL)
-        response = model.generate_content(
-            question,
-            tools=tools,
-            generation_config=GenerationConfig(temperature=0.2)
-        )
-
-        # استخراج الإجابة
-        answer = response.text if response.text else "عذراً، لم أتمكن من العثور على إجابة في الوثائق المتاحة."
+        question, conv_id = read_ask_payload()
+
+        if not model_ready():
+            return model_not_ready()
+
+        conversation = get_or_create_conversation(conv_id)
+        history = format_conversation_history(conversation)
+
+        cache_key = answer_cache_key(question, history)
+        cached = get_cached_answer(cache_key)
+        if cached is not None:
+            answer, citations = cached
+        else:
+            # استدعاء نموذج Gemini المُجهز مسبقاً مع أداة البحث (Vertex AI Search) وسجل المحادثة
+            answer, citations = generate_answer(cache_key, build_contents(history, question))
+
+        add_message(conversation, "user", question)
+        add_message(conversation, "assistant", answer, citations)
+        save_conversation(conversation)
 
         return jsonify({
             "answer": answer,
-            "conversation_id": str(uuid.uuid4())
+            "citations": citations,
+            "conversation_id": conversation.id
         })
+    except HTTPException:
+        raise
+    except VertexUnavailable as e:
+        print(f"Vertex AI unavailable in /api/ask: {e}")
+        return service_busy()
     except Exception as e:
         print(f"Internal Error in /api/ask: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/ask/stream", methods=["POST"])
+def ask_stream():
+    """نسخة متدفقة من /api/ask عبر Server-Sent Events: تُرسل أجزاء الإجابة فور توليدها
+    ثم حدث ختامي يحمل الإجابة الكاملة والمصادر ومعرف المحادثة"""
+    # التحقق من الطلب وبدء التدفق قبل إرسال الترويسات حتى تصل الأخطاء كاستجابات JSON عادية
+    try:
+        question, conv_id = read_ask_payload()
+
+        if not model_ready():
+            return model_not_ready()
+
+        conversation = get_or_create_conversation(conv_id)
+        history = format_conversation_history(conversation)
+        stream = open_answer_stream(answer_cache_key(question, history), build_contents(history, question))
+    except HTTPException:
+        raise
+    except VertexUnavailable as e:
+        print(f"Vertex AI unavailable in /api/ask/stream: {e}")
+        return service_busy()
+    except Exception as e:
+        print(f"Internal Error in /api/ask/stream: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    def sse(payload: Dict) -> str:
+        return f"data: {app.json.dumps(payload)}\n\n"
+
+    def generate():
+        try:
+            for event in stream:
+                if event.get("done"):
+                    add_message(conversation, "user", question)
+                    add_message(conversation, "assistant", event["answer"], event["citations"])
+                    save_conversation(conversation)
+                    event = dict(event, conversation_id=conversation.id)
+                yield sse(event)
+        except Exception as e:
+            print(f"Internal Error in /api/ask/stream: {e}")
+            yield sse({"error": str(e)})
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # تحرير الطلبات المنتظرة لنفس السؤال حتى لو انقطع الاتصال قبل اكتمال التدفق
+    response.call_on_close(stream.close)
+    return response
+
 if __name__ == "__main__":
-    # استخدام المنفذ المحدد من قبل Google Cloud
+    # خادم gevent للتطوير المحلي برفع حد الطلبات المتزامنة إلى 4096 بدلاً من عدد خيوط محدود
+    import grpc.experimental.gevent as grpc_gevent
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+
+    grpc_gevent.init_gevent()
+    warmup()
     port = int(os.getenv("PORT", "8080"))
-    app.run(host="0.0.0.0", port=port)
+    WSGIServer(("0.0.0.0", port), app, spawn=Pool(4096)).serve_forever()
@@ -0,0 +1,18 @@
+# إعدادات gunicorn: عامل gevent غير متزامن لأن كل طلب يقضي معظم وقته في انتظار Vertex AI
+import os
+
+bind = f":{os.getenv('PORT', '8080')}"
+worker_class = "gevent"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_connections = 1000
+timeout = 0
+
+
+def post_worker_init(worker):
+    """جعل gRPC (المستخدم داخل Vertex SDK) متوافقاً مع gevent بعد تطبيق monkey patching،
+    ثم تسخين الاتصال بـ Vertex AI قبل وصول أول طلب"""
+    import grpc.experimental.gevent as grpc_gevent
+    from rag.core import warmup
+
+    grpc_gevent.init_gevent()
+    warmup()
@@ -0,0 +1,513 @@
+"""منطق RAG المشترك: تهيئة Vertex AI، ذاكرة الإجابات المؤقتة، ومخزن المحادثات"""
+
+import os
+import uuid
+import time
+import hashlib
+import itertools
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field, asdict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from cachetools import TTLCache
+import msgpack
+import redis
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from google.api_core.exceptions import ClientError, ResourceExhausted, TooManyRequests
+from google.auth import default as google_auth_default
+from google.auth.exceptions import DefaultCredentialsError
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from google.cloud import aiplatform_v1
+import vertexai
+from vertexai.generative_models import Content, GenerativeModel, GenerationConfig, Part, Tool, grounding
+
+# 1. تحميل ملف .env ثم قراءة متغيرات البيئة (سيتم جلبها من إعدادات Cloud Run)
+load_dotenv()
+PROJECT_ID = os.getenv("PROJECT_ID")
+LOCATION = os.getenv("LOCATION", "us-central1")
+# تصحيح: استخدام نموذج مستقر ومعروف لتجنب انهيار التطبيق
+MODEL = os.getenv("MODEL", "gemini-1.5-flash") 
+DATA_STORE_ID = os.getenv("DATA_STORE_ID")
+DATASTORE_PATH = (
+    f"projects/{PROJECT_ID}/locations/{LOCATION}/collections/default_collection/dataStores/{DATA_STORE_ID}"
+    if PROJECT_ID and DATA_STORE_ID else None
+)
+
+# 2. تهيئة Vertex AI ببيانات اعتماد تُحمَّل مرة واحدة ويُجدَّد رمزها في الخلفية قبل انتهائه،
+#    حتى لا يدفع أي طلب ثمن رحلة تجديد الرمز
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_CHECK_INTERVAL = 60
+_CREDS = None
+_token_lock = threading.Lock()
+
+
+def _ensure_token() -> None:
+    """تجديد رمز الوصول فقط عند عدم صلاحيته أو اقتراب انتهائه بأقل من TOKEN_REFRESH_MARGIN ثانية"""
+    with _token_lock:
+        if _CREDS.valid and _CREDS.expiry:
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            if (_CREDS.expiry - now).total_seconds() > TOKEN_REFRESH_MARGIN:
+                return
+        _CREDS.refresh(GoogleAuthRequest())
+
+
+def _token_refresher() -> None:
+    while True:
+        try:
+            _ensure_token()
+        except Exception as e:
+            print(f"Token refresh failed: {e}")
+        time.sleep(TOKEN_CHECK_INTERVAL)
+
+
+if PROJECT_ID:
+    try:
+        _CREDS, _ = google_auth_default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    except DefaultCredentialsError as e:
+        print(f"Google credentials not found, Vertex AI calls will fail: {e}")
+    vertexai.init(project=PROJECT_ID, location=LOCATION, credentials=_CREDS)
+    if _CREDS is not None:
+        threading.Thread(target=_token_refresher, daemon=True).start()
+
+# 3. تجهيز أداة البحث والنموذج مرة واحدة عند بدء التشغيل بدلاً من إعادة بنائهما في كل طلب
+_GEN_CONFIG = GenerationConfig(temperature=0.2)
+_MODEL: Optional[GenerativeModel] = None
+if DATASTORE_PATH:
+    # فشل التهيئة لا يجب أن يمنع تشغيل التطبيق؛ model_ready() سيُبلغ عنه في كل طلب
+    try:
+        _TOOLS = [Tool.from_retrieval(grounding.Retrieval(grounding.VertexAISearch(datastore=DATASTORE_PATH)))]
+        _MODEL = GenerativeModel(MODEL, tools=_TOOLS)
+    except Exception as e:
+        print(f"Failed to initialize Vertex AI model: {e}")
+
+
+def model_ready() -> bool:
+    return _MODEL is not None
+
+
+def warmup() -> None:
+    """تهيئة قناة gRPC وبيانات الاعتماد في الخلفية حتى لا يدفع أول طلب حقيقي ثمنها.
+    نرسل طلب توليد بحد رمز واحد عبر نفس عميل PredictionService الذي تستخدمه generate_content،
+    ودون أداة البحث حتى لا يُنفَّذ بحث في مخزن البيانات"""
+    if _MODEL is None:
+        return
+
+    def _ping() -> None:
+        request = aiplatform_v1.GenerateContentRequest(
+            model=_MODEL._prediction_resource_name,
+            contents=[aiplatform_v1.Content(role="user", parts=[aiplatform_v1.Part(text="ping")])],
+            generation_config=aiplatform_v1.GenerationConfig(max_output_tokens=1),
+        )
+        try:
+            _MODEL._prediction_client.generate_content(request=request)
+        except Exception as e:
+            print(f"Vertex AI warmup failed: {e}")
+
+    threading.Thread(target=_ping, daemon=True).start()
+
+
+# حماية استدعاءات Vertex AI: إعادة المحاولة بتأخير متزايد عند تقييد المعدل (429)، وقاطع دائرة
+# يوقف الاستدعاءات مؤقتاً بعد أعطال متتالية بدلاً من مضاعفة الضغط على الخدمة
+VERTEX_RETRY_AFTER = 30
+
+
+class VertexUnavailable(Exception):
+    """Vertex AI غير متاح مؤقتاً (تقييد المعدل أو قاطع الدائرة مفتوح)؛ على العميل إعادة المحاولة لاحقاً"""
+
+
+def _is_client_error(e: Exception) -> bool:
+    # أخطاء الطلب نفسه لا تعني عطلاً في الخدمة، باستثناء تقييد المعدل
+    return isinstance(e, ClientError) and not isinstance(e, TooManyRequests)
+
+
+class _CircuitOpen(Exception):
+    pass
+
+
+class _CircuitBreaker:
+    """قاطع دائرة يمسك القفل فقط أثناء فحص الحالة أو تحديثها، ويُنفَّذ الاستدعاء نفسه خارجه
+    حتى لا تصطف استدعاءات Vertex AI المتزامنة خلف بعضها"""
+
+    def __init__(self, fail_max: int, reset_timeout: float, exclude: Callable[[Exception], bool]):
+        self._fail_max = fail_max
+        self._reset_timeout = reset_timeout
+        self._exclude = exclude
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+
+    def call(self, func, *args):
+        with self._lock:
+            if self._opened_at is not None:
+                # بعد انقضاء المهلة يُسمح باستدعاء تجريبي واحد، ويبقى الباقي مرفوضاً حتى تتضح نتيجته
+                if self._trial or time.monotonic() - self._opened_at < self._reset_timeout:
+                    raise _CircuitOpen("Vertex AI circuit breaker is open")
+                self._trial = True
+        try:
+            result = func(*args)
+        except Exception as e:
+            self._record(success=self._exclude(e))
+            raise
+        self._record(success=True)
+        return result
+
+    def _record(self, success: bool) -> None:
+        with self._lock:
+            if success:
+                self._failures = 0
+                self._opened_at = None
+            else:
+                self._failures += 1
+                if self._trial or self._failures >= self._fail_max:
+                    self._opened_at = time.monotonic()
+            self._trial = False
+
+
+_vertex_breaker = _CircuitBreaker(fail_max=5, reset_timeout=VERTEX_RETRY_AFTER, exclude=_is_client_error)
+_vertex_retry = retry(
+    retry=retry_if_exception_type(ResourceExhausted),
+    wait=wait_exponential_jitter(initial=0.5, max=4),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+
+
+@_vertex_retry
+def _generate_content(contents: List[Content]):
+    return _MODEL.generate_content(contents, generation_config=_GEN_CONFIG)
+
+
+@_vertex_retry
+def _open_stream(contents: List[Content]) -> Iterable:
+    # أخطاء الاتصال وتقييد المعدل تظهر عند أول جزء، لذا نسحبه هنا ليمر عبر إعادة المحاولة وقاطع الدائرة
+    responses = iter(_MODEL.generate_content(contents, generation_config=_GEN_CONFIG, stream=True))
+    first = next(responses, None)
+    return responses if first is None else itertools.chain([first], responses)
+
+
+def _call_vertex(func, contents: List[Content]):
+    try:
+        return _vertex_breaker.call(func, contents)
+    except (_CircuitOpen, ResourceExhausted) as e:
+        raise VertexUnavailable(str(e)) from e
+
+
+# 4. ذاكرة مؤقتة للإجابات: الأسئلة المكررة تُخدم دون رحلة كاملة إلى Vertex AI
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "2048"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "600"))
+_answer_cache: TTLCache = TTLCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+_answer_cache_lock = threading.Lock()
+_answer_cache_stats = {"hits": 0, "misses": 0}
+NO_ANSWER = "عذراً، لم أتمكن من العثور على إجابة في الوثائق المتاحة."
+
+
+def answer_cache_key(question: str, history: Optional[List[Content]] = None) -> str:
+    """مفتاح ثابت للسؤال بعد توحيد المسافات وحالة الأحرف، مع سجل المحادثة المرسل إن وُجد
+    لأن الإجابة نفسها تعتمد عليه"""
+    digest = hashlib.blake2b(question.strip().lower().encode("utf-8"))
+    for content in history or []:
+        digest.update(f"\0{content.role}\0{content.text}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_cached_answer(key: str) -> Optional[Tuple[str, List[str]]]:
+    with _answer_cache_lock:
+        cached = _answer_cache.get(key)
+        _answer_cache_stats["hits" if cached is not None else "misses"] += 1
+        return cached
+
+
+def cache_answer(key: str, answer: str, citations: List[str]) -> None:
+    with _answer_cache_lock:
+        _answer_cache[key] = (answer, citations)
+
+
+def answer_cache_info() -> Dict[str, int]:
+    with _answer_cache_lock:
+        return dict(_answer_cache_stats, size=len(_answer_cache))
+
+
+def extract_text_from_response(response) -> str:
+    """استخراج نص الإجابة دون انهيار عند حجب الرد أو غياب المرشحين"""
+    try:
+        return response.text or ""
+    except (ValueError, AttributeError, IndexError):
+        return ""
+
+
+def _unique_citations(uris: Iterable[str]) -> List[str]:
+    """إزالة الروابط الفارغة والمكررة مع الحفاظ على ترتيب ظهورها"""
+    seen = set()
+    citations: List[str] = []
+    for uri in uris:
+        if not uri or uri in seen:
+            continue
+        seen.add(uri)
+        citations.append(uri)
+    return citations
+
+
+def extract_citations_from_response(response) -> List[str]:
+    """استخراج روابط المصادر غير المكررة من بيانات grounding المرفقة بالإجابة في مرور واحد"""
+    try:
+        chunks = response.candidates[0].grounding_metadata.grounding_chunks
+    except (IndexError, AttributeError):
+        return []
+    return _unique_citations((chunk.retrieved_context or chunk.web).uri for chunk in chunks)
+
+
+# دمج الطلبات المتزامنة لنفس السؤال: الطلب الأول (القائد) يستدعي Vertex AI والبقية تنتظر نتيجته،
+# سواء كانت الطلبات عادية أو متدفقة
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+
+def _join_inflight(cache_key: str) -> Tuple[Future, bool]:
+    """إرجاع الطلب الجاري لنفس المفتاح، أو تسجيل طلب جديد يكون المستدعي قائده"""
+    with _inflight_lock:
+        future = _inflight.get(cache_key)
+        if future is not None:
+            return future, False
+        future = Future()
+        _inflight[cache_key] = future
+        return future, True
+
+
+def _finish_inflight(cache_key: str, future: Future) -> None:
+    """إزالة الطلب القائد من القائمة، مع إبلاغ المنتظرين بالخطأ إن انتهى قبل اكتمال النتيجة"""
+    if not future.done():
+        future.set_exception(RuntimeError("انقطع توليد الإجابة قبل اكتماله"))
+    with _inflight_lock:
+        if _inflight.get(cache_key) is future:
+            del _inflight[cache_key]
+
+
+def generate_answer(cache_key: str, contents: List[Content]) -> Tuple[str, List[str]]:
+    """استدعاء Vertex AI مرة واحدة لكل سؤال قيد التنفيذ وتخزين الإجابة عند نجاحها"""
+    future, is_leader = _join_inflight(cache_key)
+    if not is_leader:
+        return future.result()
+
+    try:
+        response = _call_vertex(_generate_content, contents)
+        answer = extract_text_from_response(response)
+        citations = extract_citations_from_response(response)
+        if answer:
+            cache_answer(cache_key, answer, citations)
+        else:
+            answer = NO_ANSWER
+        future.set_result((answer, citations))
+        return answer, citations
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        _finish_inflight(cache_key, future)
+
+
+class AnswerStream:
+    """أحداث إجابة متدفقة: {"delta": نص} لكل جزء ثم {"done": True, "answer": ..., "citations": [...]}.
+    يجب استدعاء close() بعد انتهاء الاستجابة حتى لا تبقى الطلبات المنتظرة معلّقة إن انقطع التدفق"""
+
+    def __init__(self, events: Iterator[Dict], on_close: Optional[Callable[[], None]] = None):
+        self._events = events
+        self._on_close = on_close
+
+    def __iter__(self) -> Iterator[Dict]:
+        return self._events
+
+    def close(self) -> None:
+        self._events.close()
+        if self._on_close is not None:
+            self._on_close()
+            self._on_close = None
+
+
+def _replay_answer(answer: str, citations: List[str]) -> Iterator[Dict]:
+    yield {"delta": answer}
+    yield {"done": True, "answer": answer, "citations": citations}
+
+
+def _follow_answer(future: Future) -> Iterator[Dict]:
+    answer, citations = future.result()
+    yield from _replay_answer(answer, citations)
+
+
+def _lead_answer(cache_key: str, future: Future, chunks: Iterable) -> Iterator[Dict]:
+    parts: List[str] = []
+    uris: List[str] = []
+    try:
+        for chunk in chunks:
+            text = extract_text_from_response(chunk)
+            if text:
+                parts.append(text)
+                yield {"delta": text}
+            uris.extend(extract_citations_from_response(chunk))
+        answer = "".join(parts)
+        citations = _unique_citations(uris)
+        if answer:
+            cache_answer(cache_key, answer, citations)
+        else:
+            answer = NO_ANSWER
+        future.set_result((answer, citations))
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        _finish_inflight(cache_key, future)
+    yield {"done": True, "answer": answer, "citations": citations}
+
+
+def open_answer_stream(cache_key: str, contents: List[Content]) -> AnswerStream:
+    """بدء إجابة متدفقة: من الذاكرة المؤقتة، أو بانتظار طلب جارٍ لنفس السؤال، أو بفتح تدفق من Vertex AI.
+    يُفتح التدفق هنا مباشرة حتى يظهر تقييد المعدل (VertexUnavailable) قبل إرسال أي استجابة"""
+    cached = get_cached_answer(cache_key)
+    if cached is not None:
+        return AnswerStream(_replay_answer(*cached))
+
+    future, is_leader = _join_inflight(cache_key)
+    if not is_leader:
+        return AnswerStream(_follow_answer(future))
+
+    try:
+        chunks = _call_vertex(_open_stream, contents)
+    except Exception as e:
+        future.set_exception(e)
+        _finish_inflight(cache_key, future)
+        raise
+    return AnswerStream(
+        _lead_answer(cache_key, future, chunks),
+        on_close=lambda: _finish_inflight(cache_key, future),
+    )
+
+
+# 5. تخزين المحادثات: في Redis عند تحديد REDIS_URL لتشاركها كل العمليات (workers)،
+#    وإلا في ذاكرة العملية عبر TTLCache الذي يحذف المنتهية صلاحيتها والأقدم عند الامتلاء بتكلفة O(1)
+MAX_CONVERSATIONS = int(os.getenv("MAX_CONVERSATIONS", "1000"))
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", "3600"))
+REDIS_URL = os.getenv("REDIS_URL")
+CACHE_CLEANUP_INTERVAL = int(os.getenv("CACHE_CLEANUP_INTERVAL", "60"))
+# حد تقريبي لحجم سجل المحادثة المرسل مع كل سؤال؛ يُقدَّر عدد الرموز بعدد الأحرف
+# بتقدير متحفظ (النص العربي أقل من 4 أحرف للرمز الواحد)
+MAX_HISTORY_TOKENS = int(os.getenv("MAX_HISTORY_TOKENS", "1500"))
+CHARS_PER_TOKEN = 3
+
+
+@dataclass
+class Message:
+    role: str
+    content: str
+    citations: List[str] = field(default_factory=list)
+    timestamp: float = field(default_factory=time.time)
+
+
+@dataclass
+class Conversation:
+    id: str
+    messages: List[Message] = field(default_factory=list)
+
+    def to_dict(self) -> Dict:
+        with conversations_lock:
+            return {"conversation_id": self.id, "messages": [asdict(m) for m in self.messages]}
+
+
+conversations: TTLCache = TTLCache(maxsize=MAX_CONVERSATIONS, ttl=CONVERSATION_TIMEOUT)
+conversations_lock = threading.RLock()
+_redis: Optional[redis.Redis] = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+
+def conversation_store_name() -> str:
+    return "redis" if _redis is not None else "memory"
+
+
+def _conversation_key(conv_id: str) -> str:
+    return f"conv:{conv_id}"
+
+
+def get_conversation(conv_id: str) -> Optional[Conversation]:
+    if _redis is not None:
+        packed = _redis.get(_conversation_key(conv_id))
+        if packed is None:
+            return None
+        data = msgpack.unpackb(packed)
+        return Conversation(id=data["id"], messages=[Message(**m) for m in data["messages"]])
+    with conversations_lock:
+        return conversations.get(conv_id)
+
+
+def save_conversation(conversation: Conversation) -> None:
+    """حفظ المحادثة وتجديد مدة صلاحيتها"""
+    if _redis is not None:
+        packed = msgpack.packb({"id": conversation.id, "messages": [asdict(m) for m in conversation.messages]})
+        _redis.setex(_conversation_key(conversation.id), CONVERSATION_TIMEOUT, packed)
+        return
+    with conversations_lock:
+        conversations[conversation.id] = conversation
+
+
+def get_or_create_conversation(conv_id: Optional[str] = None) -> Conversation:
+    """إرجاع المحادثة الموجودة أو إنشاء واحدة جديدة وحفظها"""
+    conversation = get_conversation(conv_id) if conv_id else None
+    if conversation is None:
+        conversation = Conversation(id=uuid.uuid4().hex)
+        save_conversation(conversation)
+    return conversation
+
+
+def expire_caches() -> None:
+    """حذف المحادثات والإجابات المنتهية صلاحيتها من الذاكرة؛ Redis يتولى ذلك بنفسه"""
+    with conversations_lock:
+        conversations.expire()
+    with _answer_cache_lock:
+        _answer_cache.expire()
+
+
+def _cache_cleaner() -> None:
+    while True:
+        time.sleep(CACHE_CLEANUP_INTERVAL)
+        try:
+            expire_caches()
+        except Exception as e:
+            print(f"Cache cleanup failed: {e}")
+
+
+# TTLCache لا يحذف العناصر المنتهية إلا عند الوصول إليه، لذا ننظفه دورياً في الخلفية
+# بدلاً من مسار الطلب حتى تتحرر الذاكرة في فترات الخمول أيضاً
+threading.Thread(target=_cache_cleaner, daemon=True).start()
+
+
+def add_message(conversation: Conversation, role: str, content: str, citations: Optional[List[str]] = None) -> None:
+    """إضافة رسالة إلى المحادثة؛ يجب استدعاء save_conversation بعدها لحفظ التغيير"""
+    with conversations_lock:
+        conversation.messages.append(Message(role=role, content=content, citations=citations or []))
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def format_conversation_history(conversation: Conversation) -> List[Content]:
+    """بناء سجل المحادثة من الأحدث إلى الأقدم حتى بلوغ MAX_HISTORY_TOKENS،
+    دون المصادر لأنها غير لازمة لمتابعة الحوار"""
+    history: List[Content] = []
+    budget = MAX_HISTORY_TOKENS
+    with conversations_lock:
+        messages = list(conversation.messages)
+    for message in reversed(messages):
+        budget -= estimate_tokens(message.content)
+        if budget < 0:
+            break
+        role = "user" if message.role == "user" else "model"
+        history.append(Content(role=role, parts=[Part.from_text(message.content)]))
+    history.reverse()
+    # يجب أن يبدأ السجل برسالة من المستخدم
+    while history and history[0].role != "user":
+        history.pop(0)
+    return history
+
+
+def build_contents(history: List[Content], question: str) -> List[Content]:
+    return history + [Content(role="user", parts=[Part.from_text(question)])]